@@ -25,15 +25,25 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import collections
+import concurrent.futures
+import contextlib
 import glob
+import hashlib
+import io
+import itertools
+import operator
+import pickle
+import re
 import string
 import sys
 import os
+import tempfile
 
 try:
-    from pyparsing import (Word, White, Literal, ParserElement, Regex, LineEnd,
-                           OneOrMore, Combine, Or, Optional, Suppress, Group,
-                           nums, alphanums, printables,
+    from pyparsing import (Word, White, ParserElement, Regex, LineEnd,
+                           OneOrMore, Combine, Optional, Suppress, Group,
+                           nums, alphanums,
                            stringEnd, pythonStyleComment,
                            ParseBaseException)
 except ImportError:
@@ -57,18 +67,19 @@ except ImportError:
     ecodes = None
     print('WARNING: evdev is not available')
 
+ECODE_NAMES = frozenset(ecodes) if ecodes is not None else None
+
 try:
     from functools import lru_cache
 except ImportError:
     # don't do caching on old python
-    lru_cache = lambda: (lambda f: f)
+    lru_cache = lambda **kwargs: (lambda f: f)
 
 EOL = LineEnd().suppress()
 EMPTYLINE = LineEnd()
-COMMENTLINE = pythonStyleComment + EOL
-INTEGER = Word(nums)
-REAL = Combine((INTEGER + Optional('.' + Optional(INTEGER))) ^ ('.' + INTEGER))
-SIGNED_REAL = Combine(Optional(Word('-+')) + REAL)
+INTEGER = Regex(r'[0-9]+')
+REAL = Regex(r'[0-9]+(?:\.[0-9]*)?|\.[0-9]+')
+SIGNED_REAL = Regex(r'[-+]*(?:' + REAL.pattern + ')')
 UDEV_TAG = Word(string.ascii_uppercase, alphanums + '_')
 
 # Those patterns are used in type-specific matches
@@ -111,55 +122,112 @@ GENERAL_MATCHES = {'acpi',
 def upperhex_word(length):
     return Word(nums + 'ABCDEF', exact=length)
 
+# This is a partial check of match patterns. The other cases could be also
+# done, but those two are most commonly wrong. The regex is the fast path,
+# the grammar is only used to explain what is wrong with a pattern.
+MATCH_PATTERNS = {
+    'usb': (re.compile(r'v[0-9A-F]{4}(p[0-9A-F]{4}:?)?\*'),
+            ('v' + upperhex_word(4) + Optional('p' + upperhex_word(4) + Optional(':')) + '*').leaveWhitespace()),
+    'pci': (re.compile(r'v[0-9A-F]{8}(d[0-9A-F]{8}:?)?\*'),
+            ('v' + upperhex_word(8) + Optional('d' + upperhex_word(8) + Optional(':')) + '*').leaveWhitespace()),
+}
+
 @lru_cache()
 def hwdb_grammar():
     ParserElement.setDefaultWhitespaceChars('')
 
-    prefix = Or(category + ':' + Or(conn) + ':'
-                for category, conn in TYPES.items())
-
-    matchline_typed = Combine(prefix + Word(printables + ' ' + '®'))
-    matchline_general = Combine(Or(GENERAL_MATCHES) + ':' + Word(printables + ' ' + '®'))
-    matchline = (matchline_typed | matchline_general) + EOL
+    # A single regex for all the typed and general prefixes, instead of
+    # nested Or/Combine alternatives which are tried one by one.
+    prefixes = [f'{category}:{conn}:'
+                for category, conns in TYPES.items()
+                for conn in (conns if isinstance(conns, tuple) else (conns,))]
+    prefixes += [f'{match}:' for match in sorted(GENERAL_MATCHES)]
+    matchline = Regex('(?:' + '|'.join(map(re.escape, prefixes)) + r')[\x21-\x7e ®]+').setName('match') + EOL
 
     propertyline = (White(' ', exact=1).suppress() +
-                    Combine(UDEV_TAG - '=' - Optional(Word(alphanums + '_=:@*.!-;, "/'))
+                    Combine(UDEV_TAG - '=' - Optional(Regex(r'[a-zA-Z0-9_=:@*.!\-;, "/]+'))
                             - Optional(pythonStyleComment)) +
                     EOL)
-    propertycomment = White(' ', exact=1) + pythonStyleComment + EOL
 
-    group = (OneOrMore(matchline('MATCHES*') ^ COMMENTLINE.suppress()) -
-             OneOrMore(propertyline('PROPERTIES*') ^ propertycomment.suppress()) -
+    # Comment lines are removed by strip_comments() before parsing
+    group = (OneOrMore(matchline('MATCHES*')) -
+             OneOrMore(propertyline('PROPERTIES*')) -
              (EMPTYLINE ^ stringEnd()).suppress())
-    commentgroup = OneOrMore(COMMENTLINE).suppress() - EMPTYLINE.suppress()
 
-    grammar = OneOrMore(Group(group)('GROUPS*') ^ commentgroup) + stringEnd()
+    grammar = OneOrMore(Group(group)('GROUPS*')) + stringEnd()
 
     return grammar
 
+# Either a block of comment lines that forms a group of its own, i.e. starts
+# at the beginning of the file or after an empty line and is terminated by an
+# empty line, which is dropped together with the block, or a single comment
+# line inside of a group.
+COMMENTS = re.compile(r'(?:\A|(?<=\n\n))(?:\s*#[^\n]*(?:\n|\Z))+[ \t\r]*(?:\n|\Z)'
+                      r'|^[ \t]*#[^\n]*(?:\n|\Z)',
+                      re.MULTILINE)
+
+def strip_comments(text):
+    return COMMENTS.sub('', text)
+
+def original_location(text, loc):
+    # Map a location in strip_comments(text) back to text
+    for m in COMMENTS.finditer(text):
+        if m.start() > loc:
+            break
+        loc += m.end() - m.start()
+    return loc
+
+Parsed = collections.namedtuple('Parsed', ('NAME', 'VALUE'))
+
+def one_of(*choices, optional=False):
+    def validate(value):
+        if value in choices or (optional and not value):
+            return value
+        raise ValueError(value)
+    return validate
+
+def matching(pattern):
+    regex = re.compile(pattern)
+    def validate(value):
+        if not regex.fullmatch(value):
+            raise ValueError(value)
+        return value
+    return validate
+
+def parsed_by(expr):
+    grammar = expr + stringEnd()
+    def validate(value):
+        try:
+            return grammar.parseString(value)[0]
+        except ParseBaseException as e:
+            raise ValueError(value) from e
+    return validate
+
 @lru_cache()
-def property_grammar():
+def property_validators():
     ParserElement.setDefaultWhitespaceChars(' ')
 
     dpi_setting = Group(Optional('*')('DEFAULT') + INTEGER('DPI') + Optional(Suppress('@') + INTEGER('HZ')))('SETTINGS*')
     mount_matrix_row = SIGNED_REAL + ',' + SIGNED_REAL + ',' + SIGNED_REAL
     mount_matrix = Group(mount_matrix_row + ';' + mount_matrix_row + ';' + mount_matrix_row)('MOUNT_MATRIX')
-    xkb_setting = Optional(Word(alphanums + '+-/@._'))
-    id_input_setting = Optional(Or((Literal('0'), Literal('1'))))
+    integer = matching(r'[0-9]+')
+    boolean = one_of('0', '1')
+    xkb_setting = matching(r'[a-zA-Z0-9+\-/@._]*')
+    id_input_setting = one_of('0', '1', optional=True)
 
     # Although this set doesn't cover all of characters in database entries, it's enough for test targets.
-    name_literal = Word(printables + ' ')
-
-    props = (('MOUSE_DPI', Group(OneOrMore(dpi_setting))),
-             ('MOUSE_WHEEL_CLICK_ANGLE', INTEGER),
-             ('MOUSE_WHEEL_CLICK_ANGLE_HORIZONTAL', INTEGER),
-             ('MOUSE_WHEEL_CLICK_COUNT', INTEGER),
-             ('MOUSE_WHEEL_CLICK_COUNT_HORIZONTAL', INTEGER),
-             ('ID_AUTOSUSPEND', Or((Literal('0'), Literal('1')))),
-             ('ID_AUTOSUSPEND_DELAY_MS', INTEGER),
-             ('ID_AV_PRODUCTION_CONTROLLER', Or((Literal('0'), Literal('1')))),
-             ('ID_PERSIST', Or((Literal('0'), Literal('1')))),
-             ('ID_PDA', Or((Literal('0'), Literal('1')))),
+    name_literal = matching(r'[\x21-\x7e ]+')
+
+    props = (('MOUSE_DPI', parsed_by(Group(OneOrMore(dpi_setting)))),
+             ('MOUSE_WHEEL_CLICK_ANGLE', integer),
+             ('MOUSE_WHEEL_CLICK_ANGLE_HORIZONTAL', integer),
+             ('MOUSE_WHEEL_CLICK_COUNT', integer),
+             ('MOUSE_WHEEL_CLICK_COUNT_HORIZONTAL', integer),
+             ('ID_AUTOSUSPEND', boolean),
+             ('ID_AUTOSUSPEND_DELAY_MS', integer),
+             ('ID_AV_PRODUCTION_CONTROLLER', boolean),
+             ('ID_PERSIST', boolean),
+             ('ID_PDA', boolean),
              ('ID_INPUT', id_input_setting),
              ('ID_INPUT_ACCELEROMETER', id_input_setting),
              ('ID_INPUT_JOYSTICK', id_input_setting),
@@ -173,93 +241,138 @@ def property_grammar():
              ('ID_INPUT_TOUCHPAD', id_input_setting),
              ('ID_INPUT_TOUCHSCREEN', id_input_setting),
              ('ID_INPUT_TRACKBALL', id_input_setting),
-             ('ID_SIGNAL_ANALYZER', Or((Literal('0'), Literal('1')))),
-             ('POINTINGSTICK_SENSITIVITY', INTEGER),
-             ('ID_INPUT_JOYSTICK_INTEGRATION', Or(('internal', 'external'))),
-             ('ID_INPUT_TOUCHPAD_INTEGRATION', Or(('internal', 'external'))),
+             ('ID_SIGNAL_ANALYZER', boolean),
+             ('POINTINGSTICK_SENSITIVITY', integer),
+             ('ID_INPUT_JOYSTICK_INTEGRATION', one_of('internal', 'external')),
+             ('ID_INPUT_TOUCHPAD_INTEGRATION', one_of('internal', 'external')),
              ('XKB_FIXED_LAYOUT', xkb_setting),
              ('XKB_FIXED_VARIANT', xkb_setting),
              ('XKB_FIXED_MODEL', xkb_setting),
-             ('KEYBOARD_LED_NUMLOCK', Literal('0')),
-             ('KEYBOARD_LED_CAPSLOCK', Literal('0')),
-             ('ACCEL_MOUNT_MATRIX', mount_matrix),
-             ('ACCEL_LOCATION', Or(('display', 'base'))),
-             ('PROXIMITY_NEAR_LEVEL', INTEGER),
-             ('IEEE1394_UNIT_FUNCTION_MIDI', Or((Literal('0'), Literal('1')))),
-             ('IEEE1394_UNIT_FUNCTION_AUDIO', Or((Literal('0'), Literal('1')))),
-             ('IEEE1394_UNIT_FUNCTION_VIDEO', Or((Literal('0'), Literal('1')))),
+             ('KEYBOARD_LED_NUMLOCK', one_of('0')),
+             ('KEYBOARD_LED_CAPSLOCK', one_of('0')),
+             ('ACCEL_MOUNT_MATRIX', parsed_by(mount_matrix)),
+             ('ACCEL_LOCATION', one_of('display', 'base')),
+             ('PROXIMITY_NEAR_LEVEL', integer),
+             ('IEEE1394_UNIT_FUNCTION_MIDI', boolean),
+             ('IEEE1394_UNIT_FUNCTION_AUDIO', boolean),
+             ('IEEE1394_UNIT_FUNCTION_VIDEO', boolean),
              ('ID_VENDOR_FROM_DATABASE', name_literal),
              ('ID_MODEL_FROM_DATABASE', name_literal),
-             ('ID_TAG_MASTER_OF_SEAT', Literal('1')),
-             ('ID_INFRARED_CAMERA', Or((Literal('0'), Literal('1')))),
-             ('ID_CAMERA_DIRECTION', Or(('front', 'rear'))),
-             ('SOUND_FORM_FACTOR', Or(('internal', 'webcam', 'speaker', 'headphone', 'headset', 'handset', 'microphone'))),
+             ('ID_TAG_MASTER_OF_SEAT', one_of('1')),
+             ('ID_INFRARED_CAMERA', boolean),
+             ('ID_CAMERA_DIRECTION', one_of('front', 'rear')),
+             ('SOUND_FORM_FACTOR', one_of('internal', 'webcam', 'speaker', 'headphone', 'headset', 'handset', 'microphone')),
             )
-    fixed_props = [Literal(name)('NAME') - Suppress('=') - val('VALUE')
-                   for name, val in props]
-    kbd_props = [Regex(r'KEYBOARD_KEY_[0-9a-f]+')('NAME')
-                 - Suppress('=') -
-                 ('!' ^ (Optional('!') - Word(alphanums + '_')))('VALUE')
-                ]
-    abs_props = [Regex(r'EVDEV_ABS_[0-9a-f]{2}')('NAME')
-                 - Suppress('=') -
-                 Word('-' + nums + ':')('VALUE')
-                ]
-
-    grammar = Or(fixed_props + kbd_props + abs_props) + EOL
-
-    return grammar
-
-ERROR = False
+    table = dict(props)
+    kbd_props = (re.compile(r'KEYBOARD_KEY_[0-9a-f]+'),
+                 matching(r'!|!? *[a-zA-Z0-9_]+'))
+    abs_props = (re.compile(r'EVDEV_ABS_[0-9a-f]{2}'),
+                 matching(r'[-0-9:]+'))
+
+    def lookup(name):
+        validator = table.get(name)
+        if validator:
+            return validator
+        for regex, validator in (kbd_props, abs_props):
+            if regex.fullmatch(name):
+                # the same scancodes and axes show up over and over again,
+                # remember the name so the next lookup is a plain dict hit
+                table[name] = validator
+                return validator
+        return None
+
+    return lookup
+
+# Errors are collected here and printed together after each file is checked
+ERRORS = []
 def error(fmt, *args, **kwargs):
-    global ERROR
-    ERROR = True
-    print(fmt.format(*args, **kwargs))
+    ERRORS.append(fmt.format(*args, **kwargs))
+
+_first = operator.itemgetter(0)
 
 def convert_properties(group):
-    matches = [m[0] for m in group.MATCHES]
-    props = [p[0] for p in group.PROPERTIES]
+    matches = list(map(_first, group.MATCHES))
+    # strip trailing comments once here, the cached results are then clean too
+    props = [p.partition('#')[0].rstrip() for p in map(_first, group.PROPERTIES)]
     return matches, props
 
+# If HWDB_PARSE_CACHE is set, parse results are cached in that directory,
+# keyed by the hwdb file and this script.
+CACHE_DIR = os.environ.get('HWDB_PARSE_CACHE')
+
+def cache_path(fname):
+    if not CACHE_DIR:
+        return None
+    key = []
+    for path in (os.path.abspath(fname), os.path.abspath(__file__)):
+        st = os.stat(path)
+        key += [path, str(st.st_mtime_ns), str(st.st_size)]
+    digest = hashlib.blake2b('\0'.join(key).encode()).hexdigest()
+    return os.path.join(CACHE_DIR, digest + '.pkl')
+
 def parse(fname):
+    cache = cache_path(fname)
+    if cache:
+        try:
+            with open(cache, 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception:  # pylint: disable=broad-except
+            # unpickling a damaged file can fail in many ways, just parse again
+            try:
+                os.unlink(cache)
+            except OSError:
+                pass
+
+    with open(fname, 'r', encoding='UTF-8') as f:
+        text = f.read()
+
     grammar = hwdb_grammar()
     try:
-        with open(fname, 'r', encoding='UTF-8') as f:
-            parsed = grammar.parseFile(f)
+        parsed = grammar.parseString(strip_comments(text))
     except ParseBaseException as e:
+        # report the position in the file as it is on disk
+        e.loc = original_location(text, e.loc)
+        e.pstr = text
         error('Cannot parse {}: {}', fname, e)
         return []
-    return [convert_properties(g) for g in parsed.GROUPS]
+    groups = [convert_properties(g) for g in parsed.GROUPS]
 
-def check_matches(groups):
-    matches = sum((group[0] for group in groups), [])
+    if cache:
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with tempfile.NamedTemporaryFile('wb', dir=CACHE_DIR, delete=False) as f:
+                pickle.dump(groups, f)
+            os.replace(f.name, cache)
+        except OSError:
+            pass
 
-    # This is a partial check. The other cases could be also done, but those
-    # two are most commonly wrong.
-    grammars = { 'usb' : 'v' + upperhex_word(4) + Optional('p' + upperhex_word(4) + Optional(':')) + '*',
-                 'pci' : 'v' + upperhex_word(8) + Optional('d' + upperhex_word(8) + Optional(':')) + '*',
-    }
+    return groups
+
+def check_matches(groups):
+    matches = list(itertools.chain.from_iterable(group[0] for group in groups))
 
     for match in matches:
         prefix, rest = match.split(':', maxsplit=1)
-        gr = grammars.get(prefix)
-        if gr:
+        checks = MATCH_PATTERNS.get(prefix)
+        if checks:
             # we check this first to provide an easy error message
             if rest[-1] not in '*:':
                 error('pattern {} does not end with "*" or ":"', match)
 
+            regex, gr = checks
+            if regex.match(rest):
+                continue
             try:
                 gr.parseString(rest)
             except ParseBaseException as e:
                 error('Pattern {!r} is invalid: {}', rest, e)
                 continue
 
-    matches.sort()
-    prev = None
-    for match in matches:
-        if match == prev:
-            error('Match {!r} is duplicated', match)
-        prev = match
+    counts = collections.Counter(matches)
+    for match in sorted(match for match, count in counts.items() if count > 1):
+        error('Match {!r} is duplicated', match)
 
 def check_one_default(prop, settings):
     defaults = [s for s in settings if s.DEFAULT]
@@ -270,24 +383,32 @@ def check_one_mount_matrix(prop, value):
     numbers = [s for s in value if s not in {';', ','}]
     if len(numbers) != 9:
         error('Wrong accel matrix: {!r}', prop)
+        return
     try:
         numbers = [abs(float(number)) for number in numbers]
     except ValueError:
         error('Wrong accel matrix: {!r}', prop)
+        return
     bad_x, bad_y, bad_z = max(numbers[0:3]) == 0, max(numbers[3:6]) == 0, max(numbers[6:9]) == 0
     if bad_x or bad_y or bad_z:
         error('Mount matrix is all zero in {} row: {!r}',
               'x' if bad_x else ('y' if bad_y else 'z'),
               prop)
 
+@lru_cache(maxsize=None)
+def keycode_known(name):
+    key = 'KEY_' + name
+    return (key in ECODE_NAMES or
+            name in ECODE_NAMES or
+            # new keys added in kernel 5.5
+            'KBD_LCD_MENU' in key)
+
 def check_one_keycode(value):
-    if value != '!' and ecodes is not None:
-        key = 'KEY_' + value.upper()
-        if not (key in ecodes or
-                value.upper() in ecodes or
-                 # new keys added in kernel 5.5
-                'KBD_LCD_MENU' in key):
-            error('Keycode {} unknown', key)
+    if value.startswith('!') or ECODE_NAMES is None:
+        return
+    name = value.upper()
+    if not keycode_known(name):
+        error('Keycode KEY_{} unknown', name)
 
 def check_wheel_clicks(properties):
     pairs = (('MOUSE_WHEEL_CLICK_COUNT_HORIZONTAL', 'MOUSE_WHEEL_CLICK_COUNT'),
@@ -299,28 +420,31 @@ def check_wheel_clicks(properties):
             error('{} requires {} to be specified', *pair)
 
 def check_properties(groups):
-    grammar = property_grammar()
+    validator_for = property_validators()
     for _, props in groups:
         seen_props = {}
         for prop in props:
             # print('--', prop)
-            prop = prop.partition('#')[0].rstrip()
+            name, eq, value = prop.partition('=')
+            validator = validator_for(name) if eq else None
             try:
-                parsed = grammar.parseString(prop)
-            except ParseBaseException:
+                if not validator:
+                    raise ValueError(prop)
+                parsed = Parsed(name, validator(value.lstrip(' ')))
+            except ValueError:
                 error('Failed to parse: {!r}', prop)
                 continue
             # print('{!r}'.format(parsed))
-            if parsed.NAME in seen_props:
+            # parsed is a fresh object, so a different one means a duplicate.
+            # (The value itself may be an interned string shared between lines.)
+            if seen_props.setdefault(parsed.NAME, parsed) is not parsed:
                 error('Property {} is duplicated', parsed.NAME)
-            seen_props[parsed.NAME] = parsed.VALUE
             if parsed.NAME == 'MOUSE_DPI':
                 check_one_default(prop, parsed.VALUE.SETTINGS)
             elif parsed.NAME == 'ACCEL_MOUNT_MATRIX':
                 check_one_mount_matrix(prop, parsed.VALUE)
             elif parsed.NAME.startswith('KEYBOARD_KEY_'):
-                val = parsed.VALUE if isinstance(parsed.VALUE, str) else parsed.VALUE[0]
-                check_one_keycode(val)
+                check_one_keycode(parsed.VALUE)
 
         check_wheel_clicks(seen_props)
 
@@ -332,13 +456,34 @@ def print_summary(fname, groups):
     if n_matches == 0 or n_props == 0:
         error(f'{fname}: no matches or props')
 
-if __name__ == '__main__':
-    args = sys.argv[1:] or sorted(glob.glob(os.path.dirname(sys.argv[0]) + '/[678][0-9]-*.hwdb'))
-
-    for fname in args:
+def process(fname):
+    ERRORS.clear()
+    with contextlib.redirect_stdout(io.StringIO()) as output:
         groups = parse(fname)
         print_summary(fname, groups)
         check_matches(groups)
         check_properties(groups)
+    return output.getvalue(), list(ERRORS)
+
+def process_all(fnames):
+    # Files are independent, check them in parallel, results come in order
+    try:
+        executor = concurrent.futures.ProcessPoolExecutor()
+        results = executor.map(process, fnames)
+    except (OSError, NotImplementedError):
+        # worker processes are not available in some sandboxes
+        yield from map(process, fnames)
+        return
+    with executor:
+        yield from results
+
+if __name__ == '__main__':
+    args = sys.argv[1:] or sorted(glob.glob(os.path.dirname(sys.argv[0]) + '/[678][0-9]-*.hwdb'))
+
+    failed = False
+    for output, errors in process_all(args):
+        sys.stdout.write(output + ''.join(e + '\n' for e in errors))
+        sys.stdout.flush()
+        failed = failed or bool(errors)
 
-    sys.exit(ERROR)
+    sys.exit(failed)